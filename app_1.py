@@ -1,56 +1,267 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+import numpy as np
+
 import qdrant_client
+from qdrant_client.http import models
 
-from llama_index.core import VectorStoreIndex, ServiceContext, SimpleDirectoryReader
-from llama_index.core import load_index_from_storage
+from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.ingestion import DocstoreStrategy, IngestionPipeline
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.readers.file.base import default_file_metadata_func
+from llama_index.core.schema import MetadataMode, TransformComponent
+from llama_index.core.storage.docstore import SimpleDocumentStore
 from llama_index.llms.ollama import Ollama
-from llama_index.core import StorageContext
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.embeddings.huggingface_optimum import OptimumEmbedding
+from llama_index.embeddings.huggingface.utils import get_query_instruct_for_model_name
 from llama_index.core import Settings
-from llama_index.core import set_global_service_context 
 
 import gradio as gr
+from tokenizers import Tokenizer
+
+logger = logging.getLogger(__name__)
+
+# default paths live next to this file, wherever the app is started from
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DOC_PATH = os.getenv('DOC_PATH', os.path.join(APP_DIR, 'data', 'pdf_esg'))
+INDEX_PATH = os.getenv('INDEX_PATH', os.path.join(APP_DIR, 'storage'))
+DOC_EXTS = [".pdf"]
+# a cold load of mistral can take longer than the client's 30s default
+OLLAMA_REQUEST_TIMEOUT = 120.0
+# how long Ollama keeps the model loaded after the startup warm-up (same format as the server's setting)
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+# number of Gradio sessions answered at the same time (Gradio defaults to 1)
+QUERY_CONCURRENCY = 4
+EMBED_MODEL = "BAAI/bge-small-en-v1.5"
+EMBED_ONNX_PATH = os.path.join(APP_DIR, 'bge_onnx')
+# per-chunk embedding cache, stored next to the pipeline state
+EMBED_CACHE_FILE = 'embeddings.sqlite'
+# (mtime, size) of every indexed file, so unchanged files are skipped before parsing
+MANIFEST_FILE = 'manifest.json'
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '64'))
+# bge-small-en-v1.5 reads at most 512 tokens, [CLS] and [SEP] included
+CHUNK_SIZE = 510
+CHUNK_OVERLAP = 50
+EMBED_DIM = 384
+COLLECTION_NAME = "esg"
+QDRANT_HOST = os.getenv('QDRANT_HOST', 'localhost')
+QDRANT_PORT = int(os.getenv('QDRANT_PORT', '6333'))
+QDRANT_GRPC_PORT = int(os.getenv('QDRANT_GRPC_PORT', '6334'))
+# points per upsert request when writing the index
+QDRANT_BATCH_SIZE = 256
+# HNSW graph for a corpus of well under 100k chunks; searches default to hnsw_ef=ef_construct
+HNSW_M = 16
+HNSW_EF_CONSTRUCT = 200
+# PDFs are parsed in a spawn pool of at most LOAD_WORKERS processes; every worker is a
+# fresh interpreter that re-imports this module (gradio, onnxruntime, torch), so keep it small
+LOAD_WORKERS = min(os.cpu_count() or 1, 4)
+
+def load_embed_model(model_name=EMBED_MODEL, onnx_path=EMBED_ONNX_PATH, batch_size=EMBED_BATCH_SIZE):
+    # export the model to ONNX once, later runs load the exported graph
+    if not os.path.exists(onnx_path):
+        OptimumEmbedding.create_and_save_optimum_model(model_name, onnx_path)
+    # the ONNX folder carries no model name, so pass BGE's query instruction explicitly
+    return OptimumEmbedding(
+        folder_name=onnx_path,
+        query_instruction=get_query_instruct_for_model_name(model_name),
+        embed_batch_size=batch_size,
+    )
+
+def load_splitter(onnx_path=EMBED_ONNX_PATH):
+    # count chunk tokens with the embedding model's own Rust tokenizer
+    tokenizer = Tokenizer.from_file(os.path.join(onnx_path, "tokenizer.json"))
+    return SentenceSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        tokenizer=lambda text: tokenizer.encode(text, add_special_tokens=False).ids,
+    )
+
+def init_settings():
+    # load the models when the app starts, not on import (loader workers re-import this module)
+    Settings.llm = Ollama(model="mistral", request_timeout=OLLAMA_REQUEST_TIMEOUT)
+    Settings.embed_model = load_embed_model()
+    Settings.node_parser = load_splitter()
+
+class CachedEmbedding(TransformComponent):
+    # embeds nodes like the wrapped model does, but looks every chunk up first in an
+    # SQLite table keyed by sha256(model name + chunk text) and only embeds the misses;
+    # vectors are stored as float16, half the size at ~1e-3 relative error
+    embed_model: BaseEmbedding
+    model_name: str
+    cache_path: str
+
+    def __call__(self, nodes, **kwargs):
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        keys = [hashlib.sha256(f"{self.model_name}\0{text}".encode()).digest() for text in texts]
+        conn = sqlite3.connect(self.cache_path)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB)")
+            cached = {}
+            # stay below SQLite's limit on bound parameters per statement
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                cached.update(conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ))
+            misses = [i for i, key in enumerate(keys) if key not in cached]
+            vectors = self.embed_model.get_text_embedding_batch([texts[i] for i in misses], **kwargs)
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                    [(keys[i], np.asarray(vector, dtype=np.float16).tobytes()) for i, vector in zip(misses, vectors)],
+                )
+        finally:
+            conn.close()
+
+        for i, vector in zip(misses, vectors):
+            nodes[i].embedding = vector
+        for node, key in zip(nodes, keys):
+            if key in cached:
+                node.embedding = np.frombuffer(cached[key], dtype=np.float16).astype(np.float32).tolist()
+        return nodes
 
-DOC_PATH = '/Users/simyinkuan/Documents/rag_llama/ollama-llamaindex-mixtral-python-playground/data/pdf_esg'
-INDEX_PATH = '//Users/simyinkuan/Documents/rag_llama/ollama-llamaindex-mixtral-python-playground/storage'
-Settings.llm = Ollama(model="mistral")
-Settings.embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-small-en-v1.5")
-embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-small-en-v1.5")
-service_context = ServiceContext.from_defaults(llm=Ollama(model="mistral"),embed_model = embed_model)
-set_global_service_context(service_context)
+def file_metadata(file_path):
+    # reading a PDF bumps its access time, which would change every page's hash and
+    # make each restart re-index the whole corpus
+    metadata = default_file_metadata_func(file_path)
+    metadata.pop("last_accessed_date", None)
+    return metadata
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    # write to a temporary file first so a crash never leaves a half-written manifest
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+def create_collection(client, collection_name=COLLECTION_NAME):
+    client.create_collection(
+        collection_name=collection_name,
+        # full-precision vectors are only read to rescore, so they can stay on disk
+        vectors_config=models.VectorParams(size=EMBED_DIM, distance=models.Distance.COSINE, on_disk=True),
+        hnsw_config=models.HnswConfigDiff(m=HNSW_M, ef_construct=HNSW_EF_CONSTRUCT),
+        # int8 copies of the vectors are searched from RAM, the originals rescore the top hits
+        quantization_config=models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=True
+            )
+        ),
+    )
 
 def construct_index(doc_path=DOC_PATH, index_store=INDEX_PATH, use_cache=False):
-    client = qdrant_client.QdrantClient(path="./qdrant_data")
-    vector_store = QdrantVectorStore(client=client, collection_name="esg")
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-    if use_cache:
-        # rebuild storage context
-        storage_context = StorageContext.from_defaults(persist_dir=index_store)
-        index = load_index_from_storage(storage_context)  # load index
-    else:
-        reader = SimpleDirectoryReader(input_dir="/Users/simyinkuan/Documents/rag_llama/ollama-llamaindex-mixtral-python-playground/data/pdf_esg")
-        documents = reader.load_data()
-        index = VectorStoreIndex.from_documents(documents)
-        index.storage_context.persist(index_store)
-    return None
-
-def qabot(input_text, index_store = INDEX_PATH):
-  
-
-    storage_context = StorageContext.from_defaults(persist_dir=index_store)
-
-    # Load the data
-    index = load_index_from_storage(storage_context)
-
-    query_engine = index.as_query_engine()
+    client = qdrant_client.QdrantClient(
+        host=QDRANT_HOST, port=QDRANT_PORT, grpc_port=QDRANT_GRPC_PORT, prefer_grpc=True
+    )
+    # pipeline state gets its own directory, apart from anything persisted there before
+    pipeline_store = os.path.join(index_store, "ingestion")
+    docstore_path = os.path.join(pipeline_store, "docstore.json")
+    has_pipeline_state = os.path.exists(docstore_path)
+    if not use_cache and not has_pipeline_state and client.collection_exists(COLLECTION_NAME):
+        # without the docstore every document would be added again next to its old vectors
+        client.delete_collection(COLLECTION_NAME)
+    new_collection = not client.collection_exists(COLLECTION_NAME)
+    if new_collection:
+        create_collection(client)
+    vector_store = QdrantVectorStore(
+        client=client, collection_name=COLLECTION_NAME, batch_size=QDRANT_BATCH_SIZE
+    )
+
+    if not use_cache:
+        os.makedirs(pipeline_store, exist_ok=True)
+        # earlier versions persisted the pipeline's node cache here; it is no longer used
+        old_node_cache = os.path.join(pipeline_store, "llama_cache")
+        if os.path.exists(old_node_cache):
+            os.remove(old_node_cache)
+        manifest_path = os.path.join(pipeline_store, MANIFEST_FILE)
+        docstore = SimpleDocumentStore()
+        old_manifest = {}
+        # if the stored vectors are gone, every document is re-added with an empty docstore
+        if has_pipeline_state and not new_collection:
+            docstore = SimpleDocumentStore.from_persist_path(docstore_path)
+            old_manifest = load_manifest(manifest_path)
+        embed = CachedEmbedding(
+            embed_model=Settings.embed_model,
+            model_name=EMBED_MODEL,
+            cache_path=os.path.join(pipeline_store, EMBED_CACHE_FILE),
+        )
+        pipeline = IngestionPipeline(
+            transformations=[Settings.node_parser, embed],
+            vector_store=vector_store,
+            docstore=docstore,
+            docstore_strategy=DocstoreStrategy.UPSERTS,
+            # the built-in cache keys whole batches and never evicts, CachedEmbedding replaces it;
+            # only the docstore is loaded and persisted so the cache is never read or written
+            disable_cache=True,
+        )
+
+        # listing the folder does not parse anything; only new or modified files are read
+        files = SimpleDirectoryReader(input_dir=doc_path, required_exts=DOC_EXTS).input_files
+        manifest = {}
+        for path in files:
+            stat = os.stat(path)
+            manifest[str(path)] = [stat.st_mtime, stat.st_size]
+        changed = [path for path in files if old_manifest.get(str(path)) != manifest[str(path)]]
+
+        # drop the pages of removed and modified files, unchanged files keep theirs; indexed
+        # files are also read from the docstore ids in case the manifest was not saved
+        indexed = {doc_id.rsplit("_part_", 1)[0] for doc_id in docstore.get_all_document_hashes().values()}
+        stale = ((set(old_manifest) | indexed) - set(manifest)) | {str(path) for path in changed}
+        for file_path in stale:
+            client.delete(
+                collection_name=COLLECTION_NAME,
+                points_selector=models.FilterSelector(filter=models.Filter(must=[
+                    models.FieldCondition(key="file_path", match=models.MatchValue(value=file_path))
+                ])),
+            )
+        for doc_id in list(docstore.get_all_document_hashes().values()):
+            if doc_id.rsplit("_part_", 1)[0] in stale:
+                docstore.delete_document(doc_id, raise_error=False)
+
+        if changed:
+            reader = SimpleDirectoryReader(input_files=changed, file_metadata=file_metadata, filename_as_id=True)
+            documents = reader.load_data(num_workers=min(LOAD_WORKERS, len(changed)))
+            # pages of modified files are re-added, the embedding cache skips chunks
+            # whose text was embedded before
+            pipeline.run(documents=documents)
+        docstore.persist(docstore_path)
+        save_manifest(manifest_path, manifest)
+    return VectorStoreIndex.from_vector_store(vector_store)
+
+# built once at startup and shared by every Gradio session
+query_engine = None
+
+def qabot(input_text):
+    # yield the answer as Ollama generates it so the textbox fills in token by token
     response = query_engine.query(input_text)
-    return response.response
+    answer = ""
+    for token in response.response_gen:
+        answer += token
+        yield answer
 
 if __name__ == "__main__":
-    construct_index(DOC_PATH, use_cache=False)
-    # create_index_retriever_query_engine()
+    init_settings()
+    index = construct_index(DOC_PATH, use_cache=False)
+    query_engine = index.as_query_engine(streaming=True)
+    try:
+        # an empty prompt makes Ollama load the model now instead of on the first question
+        Settings.llm.complete("", keep_alive=OLLAMA_KEEP_ALIVE)
+    except Exception as e:
+        logger.warning("Could not pre-load the Ollama model, the first question will load it: %s", e)
     iface = gr.Interface(fn=qabot, inputs=gr.Textbox(lines=7, label='Enter your query'),
                          outputs="text",
-                         title="ESG Chatbot")
+                         title="ESG Chatbot",
+                         concurrency_limit=QUERY_CONCURRENCY)
     iface.launch(share=True)
\ No newline at end of file